@@ -1,14 +1,60 @@
 # Copyright Contributors to the Pyro project.
 # SPDX-License-Identifier: Apache-2.0
 
-import numpy as np
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import torch
 
 from pyro.contrib.forecast.evaluate import backtest, logger
-from pyro.ops.stats import crps_empirical
 
 from util import M5Data
 
+# quantile levels of M5Data.quantiles, keyed by (dtype, device)
+_QUANTILES_CACHE = {}
+
+
+def _get_quantiles(dtype, device):
+    key = (dtype, device)
+    if key not in _QUANTILES_CACHE:
+        _QUANTILES_CACHE[key] = torch.tensor(M5Data.quantiles, dtype=dtype, device=device)
+    return _QUANTILES_CACHE[key]
+
+
+def quantile(samples, probs, chunk_size=2 ** 22):
+    """
+    Computes quantiles of `samples` along the leftmost (sample) dimension.
+
+    Unlike pyro.ops.stats.quantile, this sorts `samples` only once and gathers all the
+    requested order statistics, linearly interpolating between them as `numpy.quantile` does.
+    To bound the memory of sorting, `samples` is sorted in chunks over its second dimension.
+
+    :param torch.Tensor samples: a tensor with shape `num_samples x batch_shape`.
+    :param probs: a list or a 1D tensor of quantile levels in `[0, 1]`.
+    :param int chunk_size: the approximate number of elements of `samples` to sort at once.
+    :returns: a tensor with shape `len(probs) x batch_shape`.
+    """
+    if samples.dim() == 1:
+        return quantile(samples.unsqueeze(-1), probs, chunk_size).squeeze(-1)
+
+    probs = torch.as_tensor(probs, dtype=samples.dtype, device=samples.device)
+    num_samples = samples.size(0)
+    position = probs * (num_samples - 1)
+    lo = position.floor().long()
+    hi = (lo + 1).clamp(max=num_samples - 1)
+    frac = position - lo
+
+    result = samples.new_empty(samples.shape[1:] + probs.shape)
+    step = max(1, chunk_size // samples[:, :1].numel())
+    for pos in range(0, samples.size(1), step):
+        # sorting along a contiguous rightmost dim is faster than along the strided sample dim
+        chunk = samples[:, pos:pos + step].movedim(0, -1).contiguous()
+        chunk = chunk.sort(-1).values
+        torch.lerp(chunk.index_select(-1, lo), chunk.index_select(-1, hi), frac,
+                   out=result[pos:pos + step])
+    return result.movedim(-1, 0)
+
 
 @torch.no_grad()
 def eval_mae(pred, truth):
@@ -17,7 +63,7 @@ def eval_mae(pred, truth):
     """
     logger.info("Evaluating MAE...")
     pred = pred.median(0).values
-    return (pred - truth).abs().reshape(truth.shape[:-2] + (-1,)).mean(-1)
+    return (pred - truth).abs().flatten(-2).mean(-1)
 
 
 @torch.no_grad()
@@ -27,8 +73,8 @@ def eval_rmse(pred, truth):
     """
     logger.info("Evaluating RMSE...")
     pred = pred.mean(0)
-    error = pred - truth
-    return (error * error).reshape(truth.shape[:-2] + (-1,)).mean(-1).sqrt()
+    error = (pred - truth).flatten(-2)
+    return torch.linalg.vector_norm(error, dim=-1).div_(math.sqrt(error.size(-1)))
 
 
 @torch.no_grad()
@@ -37,7 +83,21 @@ def eval_crps(pred, truth):
     Like pyro.contrib.forecast.eval_crps but does not average over batch dimensions.
     """
     logger.info("Evaluating CRPS...")
-    return crps_empirical(pred, truth).reshape(truth.shape[:-2] + (-1,)).mean(-1)
+    # CRPS = E|pred - truth| - E|pred - pred'| / 2, where the second term is computed
+    # from the sorted samples as sum_i (2i - n - 1) * pred_(i) / n^2
+    num_samples = pred.size(0)
+    weight = torch.arange(1 - num_samples, num_samples, 2, dtype=pred.dtype, device=pred.device)
+    spread = torch.tensordot(weight, pred.sort(0).values, dims=1).div_(num_samples ** 2)
+    return (pred - truth).abs().mean(0).sub_(spread).flatten(-2).mean(-1)
+
+
+def _pinball_loss(pred, truth, us):
+    error = truth.unsqueeze(0) - pred
+    us = us.reshape((-1,) + (1,) * (pred.dim() - 1))
+    # pinball loss: u * error if error >= 0 else (u - 1) * error
+    loss = error.clamp(min=0).mul(us).add_(error.clamp(max=0).mul(us - 1))
+    loss = loss.mean(0)  # mean accross all quantiles
+    return loss.flatten(-2).mean(-1)
 
 
 @torch.no_grad()
@@ -46,15 +106,9 @@ def eval_pl(pred, truth):
     Computes pinball loss over 9 quantiles 0.005, 0.165, 0.25, 0.5, 0.75, 0.835, 0.975, 0.995.
     """
     logger.info("Evaluating PL...")
-    us = torch.tensor(M5Data.quantiles, dtype=pred.dtype, device=pred.device)
-    # pred = quantile(pred, probs=us, dim=0)  # 9 x batch_shape x duration x D
-    # TODO: improve the speed of pyro.ops.stats.quantile to use it here
-    pred = torch.from_numpy(np.quantile(pred.cpu().numpy(), M5Data.quantiles, axis=0)).to(
-        pred.device).type(pred.dtype)
-    error = pred - truth.unsqueeze(0)
-    us = us.reshape((-1,) + (1,) * (pred.dim() - 1)).expand(pred.shape)
-    error = torch.where(error <= 0, -us, 1 - us).mul(error).mean(0)  # mean accross all quantiles
-    return error.reshape(truth.shape[:-2] + (-1,)).mean(-1)
+    us = _get_quantiles(pred.dtype, pred.device)
+    pred = quantile(pred, us)  # 9 x batch_shape x duration x D
+    return _pinball_loss(pred, truth, us)
 
 
 DEFAULT_METRICS = {
@@ -65,33 +119,123 @@ DEFAULT_METRICS = {
 }
 
 
-def get_metric_scale(metric, train_data):
+def _get_scale_stats(train_data):
+    """
+    Computes the statistics of `train_data` which are shared by the scales of all metrics.
+    """
     duration = train_data.shape[-2]
-    lag1 = train_data - torch.nn.functional.pad(train_data[..., :-1, :], (0, 0, 1, 0))
-    # find active time: to drop the leading 0s
-    active_time = (train_data.sum(-1, keepdims=True).cumsum(-2) != 0).sum(-2, keepdims=True)
+    lag1 = torch.diff(train_data, dim=-2)
+    # find active time: to drop the leading 0s; argmax gives the first active day
+    active = train_data.sum(-1).ne(0)
+    active_time = (duration - active.int().argmax(-1)) * active.any(-1)
     # resolve the edge case: the item is not active during the backtesting train window
     # there are two situations here:
     #   + the starting day happens after the last day of train_data: we let scale = 1
     #   + the starting day is the last day: we let scale get the value of the last day
     active_time = active_time.clamp(min=2)
+    start_time = duration - active_time
     start_value = train_data.gather(
-        -2, (duration - active_time).expand(active_time.shape[:-1] + train_data.shape[-1:]))
-    norm = 2 if metric == "rmse" else 1
-    lag1_norm = lag1.abs().pow(norm).sum(-2) - start_value.squeeze(-2).abs().pow(norm)
+        -2, start_time[..., None, None].expand(start_time.shape + (1, train_data.size(-1))))
+    # lag1 contains the jump from the leading 0s to the starting day, which needs to be
+    # dropped; there is no such jump if the item is active from the first day
+    start_value = start_value.squeeze(-2) * (start_time > 0).unsqueeze(-1)
+    return lag1.abs(), active_time, start_value.abs()
+
+
+def _get_scale(norm, lag1, active_time, start_value):
+    lag1_norm = lag1.pow(norm).sum(-2) - start_value.pow(norm)
     # return 1. if train_data is all zeros, this does not matter because the weight is 0.
     lag1_norm = lag1_norm.clamp(min=1.)
-    return lag1_norm.mean(-1).div(active_time.squeeze(-1).squeeze(-1) - 1).pow(1 / norm)
+    return lag1_norm.mean(-1).div(active_time - 1).pow(1 / norm)
+
+
+def get_metric_scale(metric, train_data):
+    norm = 2 if metric == "rmse" else 1
+    return _get_scale(norm, *_get_scale_stats(train_data))
 
 
 @torch.no_grad()
-def eval_weighted_scale(metric, value, train_data, weight):
-    scale = get_metric_scale(metric, train_data)
+def eval_weighted_scale(metric, value, train_data, weight, scale_stats=None):
+    """
+    Computes the weighted scaled metric from per-timeseries metric `value`.
+
+    :param tuple scale_stats: optional statistics of `train_data` computed by
+        `_get_scale_stats`, to be reused across metrics of the same window.
+    :returns: a 0-dim tensor on the same device as `value`.
+    """
+    if scale_stats is None:
+        scale_stats = _get_scale_stats(train_data)
+    norm = 2 if metric == "rmse" else 1
+    scale = _get_scale(norm, *scale_stats)
     ws = weight * value / scale
-    return ws.sum().cpu().item()
+    return ws.sum()
+
+
+# arguments of `backtest`, inherited by the forked worker processes of `_parallel_backtest`
+_BACKTEST_ARGS = None
+
+
+def _init_backtest_worker(args, num_threads):
+    global _BACKTEST_ARGS
+    _BACKTEST_ARGS = args
+    torch.set_num_threads(num_threads)
 
 
-def m5_backtest(data, covariates, model_fn, weight=None, skip_window=0, **kwargs):
+def _backtest_window(i):
+    data, covariates, model_fn, kwargs, times, options = _BACKTEST_ARGS
+    t0, t1, t2 = times[i]
+    # restrict the data to [t0:t2] and use a large stride so that there is only one window;
+    # the options of this window are resolved beforehand, so the shifted times do not matter
+    kwargs = dict(kwargs, min_train_window=t1 - t0, stride=t2 - t0, forecaster_options=options[i])
+    window, = backtest(data[..., t0:t2, :], covariates[..., t0:t2, :], model_fn, **kwargs)
+    window["t0"] += t0
+    window["t1"] += t0
+    window["t2"] += t0
+    return window
+
+
+def _parallel_backtest(data, covariates, model_fn, num_workers, **kwargs):
+    """
+    Like pyro.contrib.forecast.backtest but trains and evaluates the windows
+    in `num_workers` processes. Falls back to pyro.contrib.forecast.backtest if
+    any window is warm started, which requires the parameters of the previous window.
+    """
+    # follow the windows of pyro.contrib.forecast.backtest
+    duration = data.size(-2)
+    train_window, test_window = kwargs.get("train_window"), kwargs.get("test_window")
+    if test_window is None:
+        stop = duration - kwargs.get("min_test_window", 1) + 1
+    else:
+        stop = duration - test_window + 1
+    if train_window is None:
+        start = kwargs.get("min_train_window", 1)
+    else:
+        start = train_window
+    times = []
+    for t1 in range(start, stop, kwargs.get("stride", 1)):
+        t0 = 0 if train_window is None else t1 - train_window
+        t2 = duration if test_window is None else t1 + test_window
+        times.append((t0, t1, t2))
+
+    forecaster_options = kwargs.get("forecaster_options", {})
+    if callable(forecaster_options):
+        options = [forecaster_options(t0=t0, t1=t1, t2=t2) for t0, t1, t2 in times]
+    else:
+        options = [forecaster_options] * len(times)
+    if any(opt.get("warm_start") for opt in options):
+        return backtest(data, covariates, model_fn, **kwargs)
+
+    # worker processes are forked so that `model_fn`, `transform`,... need not be picklable
+    num_workers = min(num_workers, len(times))
+    num_threads = max(1, torch.get_num_threads() // num_workers)
+    args = (data, covariates, model_fn, kwargs, times, options)
+    with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("fork"),
+                             initializer=_init_backtest_worker,
+                             initargs=(args, num_threads)) as ex:
+        return list(ex.map(_backtest_window, range(len(times))))
+
+
+def m5_backtest(data, covariates, model_fn, weight=None, skip_window=0, num_workers=1, **kwargs):
     """
     Backtest function with weighted metrics. See
     http://docs.pyro.ai/en/stable/contrib.forecast.html#pyro.contrib.forecast.evaluate.backtest
@@ -105,6 +249,10 @@ def m5_backtest(data, covariates, model_fn, weight=None, skip_window=0, **kwargs
 
     :param torch.Tensor weight: weight of each time series in the raw data (after transform).
     :param int skip_window: skip a small leading period of data and covariates
+    :param int num_workers: number of processes to backtest the windows in parallel.
+        This is only used for CPU data and when no window is warm started. If
+        `forecaster_options` is callable, it is called in this process with the times
+        `t0, t1, t2` of each window before the windows are dispatched.
     """
     if kwargs.get("metrics") is None:
         kwargs["metrics"] = DEFAULT_METRICS
@@ -118,18 +266,34 @@ def m5_backtest(data, covariates, model_fn, weight=None, skip_window=0, **kwargs
     weight_norm = weight.reshape((-1, raw_data.shape[-2])).sum(0)
     weight = weight / weight_norm
 
-    windows = backtest(data[..., skip_window:, :], covariates[..., skip_window:, :],
-                       model_fn, **kwargs)
-    for window in windows:
-        window["t0"] += skip_window
-        window["t1"] += skip_window
-        window["t2"] += skip_window
-        # we use all historical data before t1 to compute
-        # the scale factor of wrmsse and wspl
-        train_data = raw_data[..., :window["t1"], :]
-        w = weight[..., window["t1"] - 1]
-
-        for metric in kwargs["metrics"].keys():
-            window[f"ws_{metric}"] = eval_weighted_scale(metric, window[metric], train_data, w)
+    if num_workers > 1 and not data.is_cuda and "fork" in multiprocessing.get_all_start_methods():
+        windows = _parallel_backtest(data[..., skip_window:, :], covariates[..., skip_window:, :],
+                                     model_fn, num_workers, **kwargs)
+    else:
+        windows = backtest(data[..., skip_window:, :], covariates[..., skip_window:, :],
+                           model_fn, **kwargs)
+    # the weighted metrics are only evaluated, so no autograd bookkeeping is needed
+    with torch.inference_mode():
+        for window in windows:
+            window["t0"] += skip_window
+            window["t1"] += skip_window
+            window["t2"] += skip_window
+            # we use all historical data before t1 to compute
+            # the scale factor of wrmsse and wspl
+            train_data = raw_data[..., :window["t1"], :]
+            weight_t = weight[..., window["t1"] - 1]
+            scale_stats = _get_scale_stats(train_data)
+
+            for metric in kwargs["metrics"].keys():
+                window[f"ws_{metric}"] = eval_weighted_scale(metric, window[metric], train_data,
+                                                             weight_t, scale_stats)
+
+        # fetch all weighted metrics with a single device-to-host copy
+        ws_names = [f"ws_{metric}" for metric in kwargs["metrics"].keys()]
+        if windows:
+            ws_values = iter(torch.stack([w[name] for w in windows for name in ws_names]).tolist())
+            for window in windows:
+                for name in ws_names:
+                    window[name] = next(ws_values)
 
     return windows
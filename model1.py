@@ -25,14 +25,13 @@ import argparse
 import os
 import pickle
 
-import numpy as np
 import pyro
 import pyro.distributions as dist
 import torch
 from pyro.contrib.forecast import ForecastingModel, Forecaster
 from pyro.ops.tensor_utils import periodic_repeat
 
-from evaluate import m5_backtest
+from evaluate import m5_backtest, quantile
 from util import M5Data
 
 
@@ -117,7 +116,9 @@ def main(args):
     if args.submit:
         pyro.set_rng_seed(args.seed)
         forecaster = Forecaster(Model(), data, covariates[:-28], **forecaster_options)
-        samples = forecaster(data, covariates, num_samples=1000).exp().squeeze(-1).cpu()
+        # keep samples on the training device so that the heavy Poisson sampling
+        # and aggregation below run in parallel on GPU when `--cuda` is set
+        samples = forecaster(data, covariates, num_samples=1000).exp().squeeze(-1)
         pred = samples.mean(0)
 
         # we use top-down approach to distribute the aggregated forecast sales `pred`
@@ -125,14 +126,14 @@ def main(args):
         # the proportion is calculated based on the proportion of total sales of each time
         # during the last 28 days (this follows M5 guide's benchmark models)
         sales_last28 = m5.get_aggregated_sales(m5.aggregation_levels[-1])[:, -28:]
-        proportion = sales_last28.sum(-1) / sales_last28.sum()
-        prediction = proportion.ger(pred)
+        proportion = (sales_last28.sum(-1) / sales_last28.sum()).to(samples.device)
+        prediction = proportion.unsqueeze(-1) * pred
         # make the accuracy submission
         m5.make_accuracy_submission(args.output_file, prediction)
 
-        # Similarly, we also use top-down approach for uncertainty prediction
-        non_agg_samples = samples.unsqueeze(1) * proportion.unsqueeze(-1)
-        # Note that in the above code, we distributed the aggregated result to
+        # Similarly, we also use top-down approach for uncertainty prediction,
+        # i.e. the rate `samples.unsqueeze(1) * proportion.unsqueeze(-1)`.
+        # Note that in the above rate, we distributed the aggregated result to
         # each individual timeseries at the non-aggregated level. In other words,
         # we just scale down the aggregated predictions. The standard deviation
         # of the aggregated data is about ~7000. Hence, with 30490 non-aggregated
@@ -142,11 +143,17 @@ def main(args):
         # has Poisson distribution and the top-down approach gives prediction of
         # the rate (also the mean) of Poisson distribution. In other words,
         # we need to draw Poisson samples from the non-aggregated prediction.
-        non_agg_samples = torch.poisson(non_agg_samples)
+        # The full rate tensor is as large as `non_agg_samples`, so we compute it
+        # and draw the Poisson samples in chunks of timeseries to save memory.
+        non_agg_samples = samples.new_empty(samples.size(0), m5.num_timeseries, samples.size(-1))
+        for p, out in zip(proportion.split(1024), non_agg_samples.split(1024, dim=1)):
+            out.copy_(torch.poisson(samples.unsqueeze(1) * p.unsqueeze(-1)))
         agg_samples = m5.aggregate_samples(non_agg_samples, *m5.aggregation_levels)
-        # cast to numpy because pyro quantile implementation is memory hungry
+        # compute quantiles in chunks of timeseries so that
+        # sorting the samples does not double the memory usage
         print("Calculate quantiles...")
-        q = np.quantile(agg_samples.numpy(), m5.quantiles, axis=0)
+        q = torch.cat([quantile(x, m5.quantiles) for x in agg_samples.split(5000, dim=1)], dim=1)
+        q = q.cpu()
         print("Make uncertainty submission...")
         filename, ext = os.path.splitext(args.output_file)
         m5.make_uncertainty_submission(filename + "_uncertainty" + ext, q, float_format='%.3f')
@@ -166,7 +173,8 @@ def main(args):
                               test_window=args.test_window,
                               stride=args.stride,
                               forecaster_options=forecaster_options,
-                              seed=args.seed)
+                              seed=args.seed,
+                              num_workers=args.num_workers)
 
         # by default, the result will be saved in `results/model1.pkl` file
         with open(args.output_file, "wb") as f:
@@ -182,6 +190,8 @@ if __name__ == "__main__":
     assert pyro.__version__ >= "1.3.0"
     parser = argparse.ArgumentParser(description="Univariate M5 daily forecasting")
     parser.add_argument("--num-windows", default=3, type=int)
+    parser.add_argument("--num-workers", default=1, type=int,
+                        help="number of processes to backtest the windows in parallel on CPU")
     parser.add_argument("--test-window", default=28, type=int)
     parser.add_argument("-s", "--stride", default=35, type=int)
     parser.add_argument("-n", "--num-steps", default=1001, type=int)
@@ -20,7 +20,6 @@ import math
 import os
 import pickle
 
-import numpy as np
 import torch
 
 import pyro
@@ -29,7 +28,7 @@ from pyro.contrib.forecast import ForecastingModel, Forecaster
 from pyro.nn import PyroModule, PyroParam
 from pyro.ops.tensor_utils import periodic_repeat
 
-from evaluate import eval_mae, eval_rmse, eval_pl, m5_backtest
+from evaluate import eval_mae, eval_rmse, eval_pl, m5_backtest, quantile
 from util import M5Data
 
 
@@ -254,9 +253,10 @@ def main(args):
         samples = forecaster(data[:, :, T0:T1], covariates[T0:T2], num_samples=1000, batch_size=10)
         samples = samples.reshape(-1, m5.num_timeseries, 28)
         agg_samples = m5.aggregate_samples(samples, *m5.aggregation_levels)
-        # cast to numpy because pyro quantile implementation is memory hungry
+        # compute quantiles in chunks of timeseries so that
+        # sorting the samples does not double the memory usage
         print("Calculate quantiles...")
-        q = np.quantile(agg_samples.numpy(), m5.quantiles, axis=0)
+        q = torch.cat([quantile(x, m5.quantiles) for x in agg_samples.split(5000, dim=1)], dim=1)
         print("Make submission...")
         m5.make_uncertainty_submission(args.output_file, q, float_format='%.3f')
     else:
@@ -23,14 +23,13 @@ import argparse
 import os
 import pickle
 
-import numpy as np
 import pyro
 import pyro.distributions as dist
 import torch
 from pyro.contrib.forecast import ForecastingModel, Forecaster
 from pyro.ops.tensor_utils import periodic_repeat, periodic_features
 
-from evaluate import get_metric_scale, m5_backtest
+from evaluate import get_metric_scale, m5_backtest, quantile
 from util import M5Data
 
 
@@ -147,17 +146,20 @@ def main(args):
         print("Forecasting...")
         samples = forecaster(data[..., T0:T1, :], covariates[T0:T2],
                              num_samples=1000, batch_size=10)
+        # keep samples on the training device so that the disaggregation, Poisson sampling
+        # and aggregation below run in parallel on GPU when `--cuda` is set
         samples = samples.clamp(min=0) * scale
 
         # Compute the ratio of prediction w.r.t. the sales of last 28 days
         # first, we get the total sales of each department at each store in the last 28 days
-        dept_store_sales = m5.get_aggregated_sales(level)[:, -28:].sum(-1)
+        dept_store_sales = m5.get_aggregated_sales(level)[:, -28:].sum(-1).to(samples.device)
         dept_store_sales = dept_store_sales.reshape(m5.num_stores, m5.num_depts)
         # num_items_by_dept tells us how many items in each department
-        num_items_by_dept = torch.tensor(m5.num_items_by_dept)
+        num_items_by_dept = torch.tensor(m5.num_items_by_dept, device=samples.device)
         dept_store_sales = dept_store_sales.repeat_interleave(num_items_by_dept, dim=-1)
         # get the sales at the lowest level: store+item (this is the non-aggregated level)
         sales_last28 = m5.get_aggregated_sales(["store_id", "item_id"])[:, -28:].sum(-1)
+        sales_last28 = sales_last28.to(samples.device)
         proportion = sales_last28 / dept_store_sales.reshape(-1)
 
         # after calculate the ratio, we disaggregate prediction to the bottom level
@@ -166,9 +168,11 @@ def main(args):
         non_agg_samples = torch.poisson(samples * proportion.unsqueeze(-1))
         # aggregate the result to all aggregation levels
         agg_samples = m5.aggregate_samples(non_agg_samples, *m5.aggregation_levels)
-        # cast to numpy because pyro quantile implementation is memory hungry
+        # compute quantiles in chunks of timeseries so that
+        # sorting the samples does not double the memory usage
         print("Calculate quantiles...")
-        q = np.quantile(agg_samples.numpy(), m5.quantiles, axis=0)
+        q = torch.cat([quantile(x, m5.quantiles) for x in agg_samples.split(5000, dim=1)], dim=1)
+        q = q.cpu()
         print("Make uncertainty submission...")
         filename, ext = os.path.splitext(args.output_file)
         m5.make_uncertainty_submission(filename + "_uncertainty" + ext, q, float_format='%.3f')
@@ -191,7 +195,8 @@ def main(args):
                               forecaster_options=forecaster_options,
                               num_samples=1000,
                               batch_size=10,
-                              seed=args.seed)
+                              seed=args.seed,
+                              num_workers=args.num_workers)
 
         with open(args.output_file, "wb") as f:
             pickle.dump(windows, f)
@@ -205,6 +210,8 @@ if __name__ == "__main__":
     assert pyro.__version__ >= "1.3.0"
     parser = argparse.ArgumentParser(description="Univariate M5 daily forecasting")
     parser.add_argument("--num-windows", default=3, type=int)
+    parser.add_argument("--num-workers", default=1, type=int,
+                        help="number of processes to backtest the windows in parallel on CPU")
     parser.add_argument("--test-window", default=28, type=int)
     parser.add_argument("-s", "--stride", default=35, type=int)
     parser.add_argument("-n", "--num-steps", default=2001, type=int)
@@ -1,10 +1,17 @@
 # Copyright Contributors to the Pyro project.
 # SPDX-License-Identifier: Apache-2.0
 
+import numpy as np
+import pyro
+import pyro.distributions as dist
 import pytest
 import torch
+from pyro.contrib.forecast import ForecastingModel
+from pyro.ops.stats import crps_empirical
 
-from evaluate import DEFAULT_METRICS, eval_weighted_scale
+from evaluate import (DEFAULT_METRICS, eval_crps, eval_pl, eval_weighted_scale, m5_backtest,
+                      quantile)
+from util import M5Data
 
 
 @pytest.mark.parametrize("batch_shape", [(), (4,), (2, 3)])
@@ -29,3 +36,101 @@ def test_weighted_scale_metric(batch_shape, obs_dim, metric):
     actual = eval_weighted_scale(metric, value, train_data, weight)
     expected = eval_weighted_scale(metric, value, active_data, weight)
     assert actual == expected
+
+
+@pytest.mark.parametrize("chunk_size", [1, 10, 2 ** 22])
+@pytest.mark.parametrize("batch_shape", [(), (4,), (2, 3)])
+@pytest.mark.parametrize("num_samples", [1, 2, 7, 1000])
+def test_quantile(batch_shape, num_samples, chunk_size):
+    samples = torch.randn((num_samples,) + batch_shape)
+    actual = quantile(samples, M5Data.quantiles, chunk_size=chunk_size)
+    expected = np.quantile(samples.numpy(), M5Data.quantiles, axis=0)
+    assert actual.shape == (len(M5Data.quantiles),) + batch_shape
+    assert np.allclose(actual.numpy(), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("batch_shape", [(), (4,), (2, 3)])
+@pytest.mark.parametrize("num_samples", [1, 2, 7, 1000])
+def test_eval_crps(batch_shape, num_samples):
+    truth = torch.randn(batch_shape + (20, 2)).exp()
+    pred = torch.randn((num_samples,) + truth.shape).exp()
+    actual = eval_crps(pred, truth)
+    expected = crps_empirical(pred, truth).flatten(-2).mean(-1)
+    assert actual.shape == batch_shape
+    assert torch.allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("batch_shape", [(), (4,), (2, 3)])
+@pytest.mark.parametrize("num_samples", [1, 2, 7, 1000])
+def test_eval_pl(batch_shape, num_samples):
+    truth = torch.randn(batch_shape + (20, 2)).exp()
+    pred = torch.randn((num_samples,) + truth.shape).exp()
+    actual = eval_pl(pred, truth)
+
+    us = torch.tensor(M5Data.quantiles).reshape((-1,) + (1,) * (pred.dim() - 1))
+    pred_quantiles = torch.from_numpy(np.quantile(pred.numpy(), M5Data.quantiles, axis=0))
+    error = pred_quantiles.float() - truth
+    expected = torch.where(error <= 0, -us, 1 - us).mul(error).mean(0).flatten(-2).mean(-1)
+    assert actual.shape == batch_shape
+    assert torch.allclose(actual, expected, rtol=1e-5, atol=1e-6)
+
+
+class Model(ForecastingModel):
+    def model(self, zero_data, covariates):
+        loc = pyro.sample("loc", dist.Normal(0, 10))
+        scale = pyro.sample("scale", dist.LogNormal(0, 1))
+        self.predict(dist.Normal(0, scale[..., None, None]), loc[..., None, None] + zero_data)
+
+
+@pytest.mark.parametrize("skip_window", [0, 5])
+@pytest.mark.parametrize("train_window", [None, 15])
+def test_m5_backtest_num_workers(train_window, skip_window):
+    duration = 60
+    data = torch.randn(duration, 1).exp()
+    covariates = torch.zeros(duration, 0)
+
+    def forecaster_options(t0=None, t1=None, t2=None):
+        # the results depend on the window times passed to forecaster_options
+        return {"num_steps": 1 + (t1 or 0) % 3, "log_every": 1}
+
+    windows = {}
+    for num_workers in [1, 2]:
+        windows[num_workers] = m5_backtest(data, covariates, Model,
+                                           skip_window=skip_window,
+                                           train_window=train_window,
+                                           min_train_window=20,
+                                           test_window=10,
+                                           stride=10,
+                                           forecaster_options=forecaster_options,
+                                           num_samples=10,
+                                           num_workers=num_workers)
+    assert len(windows[1]) == len(windows[2]) > 1
+    for expected, actual in zip(windows[1], windows[2]):
+        for name in ["t0", "t1", "t2"] + [f"ws_{metric}" for metric in DEFAULT_METRICS]:
+            assert actual[name] == expected[name]
+
+
+@pytest.mark.parametrize("warm_start_t1", [None, 40])
+def test_m5_backtest_num_workers_forecaster_options(warm_start_t1):
+    duration = 60
+    data = torch.randn(duration, 1).exp()
+    covariates = torch.zeros(duration, 0)
+
+    # a callable with required arguments, which is only warm started at some windows
+    def forecaster_options(t0, t1, t2):
+        warm_start = warm_start_t1 is not None and t1 >= warm_start_t1
+        return {"num_steps": 1 + t1 % 3, "log_every": 1, "warm_start": warm_start}
+
+    windows = {}
+    for num_workers in [1, 2]:
+        windows[num_workers] = m5_backtest(data, covariates, Model,
+                                           min_train_window=20,
+                                           test_window=10,
+                                           stride=10,
+                                           forecaster_options=forecaster_options,
+                                           num_samples=10,
+                                           num_workers=num_workers)
+    assert len(windows[1]) == len(windows[2]) > 1
+    for expected, actual in zip(windows[1], windows[2]):
+        for name in ["t0", "t1", "t2"] + [f"ws_{metric}" for metric in DEFAULT_METRICS]:
+            assert actual[name] == expected[name]
@@ -346,6 +346,19 @@ class M5Data:
         assert samples.dim() == 3
         assert samples.size(1) == self.num_timeseries
         num_samples, duration = samples.size(0), samples.size(-1)
+        if extra_levels:
+            # write the result of each level into a preallocated tensor, so we do not need to
+            # hold the results of all levels together with their concatenation in memory
+            levels = (level,) + extra_levels
+            sizes = [self.num_aggregations_by_level[self.aggregation_levels.index(lv)]
+                     for lv in levels]
+            out = samples.new_empty(num_samples, sum(sizes), duration)
+            pos = 0
+            for lv, n in zip(levels, sizes):
+                out[:, pos:pos + n] = self.aggregate_samples(samples, lv)
+                pos = pos + n
+            return out
+
         x = samples.reshape(num_samples, self.num_stores, self.num_items, duration)
 
         if "state_id" in level:
@@ -380,13 +393,7 @@ class M5Data:
             x = x.sum(2, keepdim=True)
 
         n = self.num_aggregations_by_level[self.aggregation_levels.index(level)]
-        x = x.reshape(num_samples, n, duration)
-        if extra_levels:
-            tmp = [x]
-            for level in extra_levels:
-                tmp.append(self.aggregate_samples(samples, level))
-            x = torch.cat(tmp, 1)
-        return x
+        return x.reshape(num_samples, n, duration)
 
     def make_accuracy_submission(self, filename, prediction):
         """